@@ -5,22 +5,26 @@ This server acts as a bridge between ACP clients (like Toad) and the GLM 4.6 API
 """
 
 import asyncio
-import json
+import hashlib
+import itertools
 import os
+import re
+import stat
 import sys
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Dict, List, Optional
+import aiofiles
 import httpx
+import orjson
 from pathlib import Path
 
-# Load environment variables from .env file if it exists
+# Load environment variables from .env file if it exists, unless the API key
+# was already provided by the parent process
 env_file = Path(__file__).parent / ".env"
-if env_file.exists():
-    with open(env_file) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                os.environ[key.strip()] = value.strip()
+if not os.environ.get("GLM_API_KEY") and env_file.exists():
+    _env_line = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=(.*)$", re.M)
+    for match in _env_line.finditer(env_file.read_text()):
+        os.environ[match.group(1)] = match.group(2).strip()
 
 # Get API key from environment variable
 GLM_API_KEY = os.environ.get("GLM_API_KEY")
@@ -31,119 +35,263 @@ if not GLM_API_KEY:
 # GLM API configuration
 GLM_API_BASE = "https://open.bigmodel.cn/api/paas/v4/"
 GLM_MODEL = "glm-4.6"
+GLM_CHAT_URL = GLM_API_BASE + "chat/completions"
+GLM_HEADERS = {
+    "Authorization": f"Bearer {GLM_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+# Number of bytes requested from stdin per read; each read may carry several frames
+STDIN_READ_SIZE = 65536
+
+# Streaming configuration (optional pacing delay in seconds between chunks)
+STREAM_CHUNK_SIZE = 4096
+STREAM_CHUNK_DELAY = float(os.environ.get("GLM_STREAM_DELAY", "0"))
+
+# Exact-match response cache (opt-in, useful for deterministic prompts)
+RESPONSE_CACHE_ENABLED = os.environ.get("GLM_ACP_CACHE") == "1"
+RESPONSE_CACHE_MAX = 256
+
+# Methods with no side effects, which may be handled out of arrival order
+CONCURRENT_METHODS = frozenset({"initialize"})
+
+# Maximum number of GLM requests in flight at once (prompts are currently
+# handled one at a time, so this only matters for concurrent callers)
+GLM_MAX_CONCURRENCY = int(os.environ.get("GLM_MAX_CONCURRENCY", "8"))
+if GLM_MAX_CONCURRENCY < 1:
+    print("Error: GLM_MAX_CONCURRENCY must be at least 1", file=sys.stderr)
+    sys.exit(1)
+
+# Number of most recent messages (user + assistant) resent to the model; older
+# turns are dropped whole so the window always starts with a user message
+HISTORY_MAX_MESSAGES = int(os.environ.get("GLM_HISTORY_MESSAGES", "12"))
+if HISTORY_MAX_MESSAGES < 2:
+    print("Error: GLM_HISTORY_MESSAGES must be at least 2", file=sys.stderr)
+    sys.exit(1)
+
+# Optional system prompt sent ahead of the history window
+GLM_SYSTEM_PROMPT = os.environ.get("GLM_SYSTEM_PROMPT")
+
+# Static response bodies, built once instead of per request
+INITIALIZE_RESULT = {
+    "protocolVersion": "2024-11-05",
+    "agentCapabilities": {
+        "loadSession": False,
+        "promptCapabilities": {
+            "audio": False,
+            "embeddedContent": False,
+            "image": False,
+        }
+    },
+    "authMethods": []
+}
+SESSION_MODES = {
+    "currentModeId": "chat",
+    "availableModes": [
+        {
+            "id": "chat",
+            "name": "Chat",
+            "description": "General conversation mode"
+        }
+    ]
+}
+
+class PathOutsideRoot(ValueError):
+    """Raised when a requested file path resolves outside the project root"""
+
+def _write(data: bytes):
+    """Write an encoded JSON-RPC message to stdout as a single line"""
+    out = sys.stdout.buffer
+    out.write(data)
+    out.write(b"\n")
+    out.flush()
+
+def _emit(obj):
+    """Encode and write a JSON-RPC message to stdout"""
+    _write(orjson.dumps(obj))
+
+def _ok(request_id, result) -> bytes:
+    """Encode a JSON-RPC success response"""
+    return orjson.dumps({"jsonrpc": "2.0", "id": request_id, "result": result})
+
+def _err(request_id, code: int, message: str) -> bytes:
+    """Encode a JSON-RPC error response"""
+    return orjson.dumps({
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "error": {"code": code, "message": message}
+    })
+
+def _is_int(value) -> bool:
+    """Whether a decoded JSON value is an integer (booleans excluded)"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _read_line_range(path, start, stop):
+    """Read lines [start, stop) of a text file without loading the whole file"""
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return "\n".join(line.rstrip("\n") for line in itertools.islice(f, start, stop))
 
 class ACPServer:
     """ACP Server implementation for GLM 4.6"""
     
     def __init__(self):
-        self.conversation_history = []
+        self.conversation_history = deque()
+        # System message is kept outside the window so it is never evicted
+        self._system_msg: Optional[Dict[str, Any]] = (
+            {"role": "system", "content": GLM_SYSTEM_PROMPT} if GLM_SYSTEM_PROMPT else None
+        )
         self.session_id = "glm-session-001"
-        self.project_root = Path("./").resolve()
+        self._set_project_root(Path("./"))
+        # Shared client so keep-alive connections are reused across prompts
+        self._http = httpx.AsyncClient(
+            headers=GLM_HEADERS,
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+        # Caps concurrent GLM calls so the shared connection pool is reused, not thrashed
+        self._glm_sem = asyncio.Semaphore(GLM_MAX_CONCURRENCY)
+        # Assistant replies keyed by a hash of the canonical request payload
+        self._resp_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        # The session/new result never changes for the lifetime of the server
+        self._session_new_result = {
+            "sessionId": self.session_id,
+            "modes": SESSION_MODES
+        }
+        # Method name -> handler, built once instead of an if/elif chain per request
+        self._dispatch = {
+            "initialize": self.handle_initialize,
+            "session/new": self.handle_session_new,
+            "session/prompt": self.handle_session_prompt,
+            "session/cancel": self.handle_session_cancel,
+            "session/set_mode": self.handle_session_set_mode,
+            "fs/read_text_file": self.handle_read_text_file,
+            "fs/write_text_file": self.handle_write_text_file,
+        }
+    
+    def _set_project_root(self, path: Path):
+        """Set the project root and cache its string prefix for path checks"""
+        self.project_root = path.resolve()
+        self._project_root_str = os.path.join(str(self.project_root), "")
+    
+    def _resolve(self, file_path: str) -> str:
+        """Resolve a path relative to the project root, rejecting escapes"""
+        full_path = os.path.realpath(os.path.join(self._project_root_str, file_path))
+        if full_path != str(self.project_root) and not full_path.startswith(self._project_root_str):
+            raise PathOutsideRoot(f"Path is outside the project root: {file_path}")
+        return full_path
+    
+    async def aclose(self):
+        """Close the shared HTTP client"""
+        await self._http.aclose()
     
-    async def call_glm_api(self, messages: List[Dict[str, Any]], **kwargs) -> Dict[str, Any]:
-        """Make a call to the GLM API"""
-        headers = {
-            "Authorization": f"Bearer {GLM_API_KEY}",
-            "Content-Type": "application/json"
+    def _trim_history(self):
+        """Drop the oldest whole turns until the history fits the window"""
+        history = self.conversation_history
+        while len(history) > HISTORY_MAX_MESSAGES:
+            history.popleft()
+            while history and history[0]["role"] != "user":
+                history.popleft()
+    
+    def _build_messages(self) -> List[Dict[str, Any]]:
+        """Build the message list sent to GLM from the history window"""
+        messages = [self._system_msg] if self._system_msg else []
+        messages.extend(self.conversation_history)
+        return messages
+    
+    def _cache_key(self, messages: List[Dict[str, Any]], **kwargs) -> bytes:
+        """Hash the canonical GLM request payload for the response cache"""
+        payload = {
+            "model": GLM_MODEL,
+            "messages": messages,
+            **kwargs
         }
-        
+        return hashlib.blake2b(
+            orjson.dumps(payload, option=orjson.OPT_SORT_KEYS),
+            digest_size=16
+        ).digest()
+    
+    def _cache_get(self, cache_key: bytes) -> Optional[str]:
+        """Return a cached assistant reply, marking it most recently used"""
+        cached = self._resp_cache.get(cache_key)
+        if cached is not None:
+            self._resp_cache.move_to_end(cache_key)
+        return cached
+    
+    def _cache_put(self, cache_key: bytes, reply: str):
+        """Cache an assistant reply, evicting the least recently used entry"""
+        self._resp_cache[cache_key] = reply
+        if len(self._resp_cache) > RESPONSE_CACHE_MAX:
+            self._resp_cache.popitem(last=False)
+    
+    async def call_glm_api_stream(self, messages: List[Dict[str, Any]], **kwargs) -> AsyncIterator[str]:
+        """Make a streaming call to the GLM API, yielding content deltas"""
         payload = {
             "model": GLM_MODEL,
             "messages": messages,
+            "stream": True,
             **kwargs
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{GLM_API_BASE}chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=60.0
-            )
+        async with self._glm_sem, self._http.stream("POST", GLM_CHAT_URL, content=orjson.dumps(payload)) as response:
             response.raise_for_status()
-            return response.json()
+            # Split SSE lines on the raw bytes so frames go to orjson undecoded
+            buf = bytearray()
+            async for chunk in response.aiter_bytes():
+                buf += chunk
+                start = 0
+                while (nl := buf.find(b"\n", start)) != -1:
+                    line = bytes(buf[start:nl])
+                    start = nl + 1
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        return
+                    choices = orjson.loads(data).get("choices") or [{}]
+                    content = choices[0].get("delta", {}).get("content")
+                    if content:
+                        yield content
+                del buf[:start]
     
     async def handle_request(self, request_data):
-        """Handle ACP request"""
+        """Handle ACP request, returning the encoded JSON-RPC response"""
+        if not isinstance(request_data, dict):
+            return _err(None, -32600, "Invalid Request")
+        
         try:
             method = request_data.get("method")
             params = request_data.get("params", {})
             request_id = request_data.get("id")
             
-            if method == "initialize":
-                return await self.handle_initialize(params, request_id)
-            elif method == "session/new":
-                return await self.handle_session_new(params, request_id)
-            elif method == "session/prompt":
-                return await self.handle_session_prompt(params, request_id)
-            elif method == "session/cancel":
-                return await self.handle_session_cancel(params, request_id)
-            elif method == "session/set_mode":
-                return await self.handle_session_set_mode(params, request_id)
-            elif method == "fs/read_text_file":
-                return await self.handle_read_text_file(params, request_id)
-            elif method == "fs/write_text_file":
-                return await self.handle_write_text_file(params, request_id)
-            else:
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "error": {
-                        "code": -32601,
-                        "message": f"Method not found: {method}"
-                    }
-                }
+            handler = self._dispatch.get(method)
+            
+            # Notifications (no "id") are processed but never answered
+            if "id" not in request_data:
+                if handler is not None:
+                    await handler(params, None)
+                return None
+            
+            if handler is None:
+                return _err(request_id, -32601, f"Method not found: {method}")
+            return await handler(params, request_id)
         except Exception as e:
-            return {
-                "jsonrpc": "2.0",
-                "id": request_data.get("id"),
-                "error": {
-                    "code": -32603,
-                    "message": f"Internal error: {str(e)}"
-                }
-            }
+            if "id" not in request_data:
+                return None
+            return _err(request_data.get("id"), -32603, f"Internal error: {str(e)}")
     
     async def handle_initialize(self, params, request_id):
         """Handle initialize request"""
-        return {
-            "jsonrpc": "2.0",
-            "id": request_id,
-            "result": {
-                "protocolVersion": "2024-11-05",
-                "agentCapabilities": {
-                    "loadSession": False,
-                    "promptCapabilities": {
-                        "audio": False,
-                        "embeddedContent": False,
-                        "image": False,
-                    }
-                },
-                "authMethods": []
-            }
-        }
+        return _ok(request_id, INITIALIZE_RESULT)
     
     async def handle_session_new(self, params, request_id):
         """Handle session/new request"""
-        project_path = params.get("projectPath", str(self.project_root))
-        self.project_root = Path(project_path).resolve()
+        project_path = params.get("projectPath")
+        if project_path is not None:
+            self._set_project_root(Path(project_path))
+        # A new session starts a fresh conversation
+        self.conversation_history.clear()
         
-        return {
-            "jsonrpc": "2.0",
-            "id": request_id,
-            "result": {
-                "sessionId": self.session_id,
-                "modes": {
-                    "currentModeId": "chat",
-                    "availableModes": [
-                        {
-                            "id": "chat",
-                            "name": "Chat",
-                            "description": "General conversation mode"
-                        }
-                    ]
-                }
-            }
-        }
+        return _ok(request_id, self._session_new_result)
     
     async def handle_session_prompt(self, params, request_id):
         """Handle session/prompt request"""
@@ -157,87 +305,72 @@ class ACPServer:
                 user_message += content_block.get("text", "")
         
         if not user_message:
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "error": {
-                    "code": -32602,
-                    "message": "No message content provided"
-                }
-            }
+            return _err(request_id, -32602, "No message content provided")
         
         # Add to conversation history
         self.conversation_history.append({"role": "user", "content": user_message})
+        self._trim_history()
         
         try:
-            # Call GLM API
-            response = await self.call_glm_api(
-                messages=self.conversation_history,
-                temperature=0.7,
-                max_tokens=1024
-            )
+            messages = self._build_messages()
+            options = {"temperature": 0.7, "max_tokens": 1024}
+            cache_key = self._cache_key(messages, **options) if RESPONSE_CACHE_ENABLED else None
+            cached = self._cache_get(cache_key) if cache_key is not None else None
             
-            assistant_message = response.get("choices", [{}])[0].get("message", {}).get("content", "")
-            self.conversation_history.append({"role": "assistant", "content": assistant_message})
+            if cached is not None:
+                # Cached replies are complete, so replay them in chunks
+                assistant_message = cached
+                await self.send_streaming_response(assistant_message, request_id)
+            else:
+                # Forward tokens to the client as they arrive from GLM
+                assembled = []
+                async for token in self.call_glm_api_stream(messages=messages, **options):
+                    self.send_message_chunk(token)
+                    assembled.append(token)
+                assistant_message = "".join(assembled)
+                if cache_key is not None:
+                    self._cache_put(cache_key, assistant_message)
             
-            # Send the response in chunks (simulating streaming)
-            await self.send_streaming_response(assistant_message, request_id)
+            self.conversation_history.append({"role": "assistant", "content": assistant_message})
             
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "result": {
-                    "stopReason": "completed"
-                }
-            }
+            return _ok(request_id, {"stopReason": "completed"})
             
         except Exception as e:
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "error": {
-                    "code": -32603,
-                    "message": f"GLM API error: {str(e)}"
+            # Drop the unanswered message so a retry rebuilds the same payload
+            self.conversation_history.pop()
+            return _err(request_id, -32603, f"GLM API error: {str(e)}")
+    
+    def send_message_chunk(self, text):
+        """Send a single agent_message_chunk update to the client"""
+        notification = {
+            "jsonrpc": "2.0",
+            "method": "session/update",
+            "params": {
+                "sessionId": self.session_id,
+                "sessionUpdate": "agent_message_chunk",
+                "content": {
+                    "type": "text",
+                    "text": text
                 }
             }
+        }
+        _emit(notification)
     
     async def send_streaming_response(self, message, request_id):
         """Send streaming response to client"""
-        # Split message into chunks for streaming effect
-        chunks = [message[i:i+50] for i in range(0, len(message), 50)]
-        
-        for chunk in chunks:
-            notification = {
-                "jsonrpc": "2.0",
-                "method": "session/update",
-                "params": {
-                    "sessionId": self.session_id,
-                    "sessionUpdate": "agent_message_chunk",
-                    "content": {
-                        "type": "text",
-                        "text": chunk
-                    }
-                }
-            }
-            print(json.dumps(notification), flush=True)
-            await asyncio.sleep(0.1)  # Simulate streaming delay
+        for i in range(0, len(message), STREAM_CHUNK_SIZE):
+            self.send_message_chunk(message[i:i + STREAM_CHUNK_SIZE])
+            if STREAM_CHUNK_DELAY:
+                await asyncio.sleep(STREAM_CHUNK_DELAY)
     
     async def handle_session_cancel(self, params, request_id):
         """Handle session/cancel request"""
-        return {
-            "jsonrpc": "2.0",
-            "id": request_id,
-            "result": {}
-        }
+        return _ok(request_id, {})
     
     async def handle_session_set_mode(self, params, request_id):
         """Handle session/set_mode request"""
         mode_id = params.get("modeId", "chat")
-        return {
-            "jsonrpc": "2.0",
-            "id": request_id,
-            "result": {}
-        }
+        return _ok(request_id, {})
     
     async def handle_read_text_file(self, params, request_id):
         """Handle fs/read_text_file request"""
@@ -245,45 +378,29 @@ class ACPServer:
         line = params.get("line")
         limit = params.get("limit")
         
+        if line is not None and not _is_int(line):
+            return _err(request_id, -32602, "Invalid params: line must be an integer")
+        if limit is not None and not (_is_int(limit) and limit >= 0):
+            return _err(request_id, -32602, "Invalid params: limit must be a non-negative integer")
+        
         try:
-            full_path = self.project_root / file_path
-            if not full_path.exists():
-                return {
-                    "jsonrpc": "2.0",
-                    "id": request_id,
-                    "error": {
-                        "code": -32602,
-                        "message": f"File not found: {file_path}"
-                    }
-                }
-            
-            content = full_path.read_text(encoding="utf-8", errors="ignore")
-            
-            if line is not None:
-                line = max(0, line - 1)
-                lines = content.splitlines()
-                if limit is None:
-                    content = "\n".join(lines[line:])
-                else:
-                    content = "\n".join(lines[line:line + limit])
+            full_path = self._resolve(file_path)
+            if line is None:
+                async with aiofiles.open(full_path, "r", encoding="utf-8", errors="ignore") as f:
+                    content = await f.read()
+            else:
+                start = max(0, line - 1)
+                stop = None if limit is None else start + limit
+                content = await asyncio.to_thread(_read_line_range, full_path, start, stop)
             
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "result": {
-                    "content": content
-                }
-            }
+            return _ok(request_id, {"content": content})
             
+        except FileNotFoundError:
+            return _err(request_id, -32602, f"File not found: {file_path}")
+        except PathOutsideRoot as e:
+            return _err(request_id, -32602, str(e))
         except Exception as e:
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "error": {
-                    "code": -32603,
-                    "message": f"Error reading file: {str(e)}"
-                }
-            }
+            return _err(request_id, -32603, f"Error reading file: {str(e)}")
     
     async def handle_write_text_file(self, params, request_id):
         """Handle fs/write_text_file request"""
@@ -291,72 +408,124 @@ class ACPServer:
         content = params.get("content", "")
         
         try:
-            full_path = self.project_root / file_path
-            full_path.parent.mkdir(parents=True, exist_ok=True)
-            full_path.write_text(content, encoding="utf-8", errors="ignore")
+            full_path = self._resolve(file_path)
+            await asyncio.to_thread(os.makedirs, os.path.dirname(full_path), exist_ok=True)
+            async with aiofiles.open(full_path, "w", encoding="utf-8", errors="ignore") as f:
+                await f.write(content)
             
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "result": {}
-            }
+            return _ok(request_id, {})
             
+        except PathOutsideRoot as e:
+            return _err(request_id, -32602, str(e))
         except Exception as e:
-            return {
-                "jsonrpc": "2.0",
-                "id": request_id,
-                "error": {
-                    "code": -32603,
-                    "message": f"Error writing file: {str(e)}"
-                }
-            }
+            return _err(request_id, -32603, f"Error writing file: {str(e)}")
+
+async def _respond(server, request_data):
+    """Handle a parsed JSON-RPC request, emitting its response"""
+    try:
+        response = await server.handle_request(request_data)
+        if response:
+            _write(response)
+    except Exception as e:
+        request_id = request_data.get("id") if isinstance(request_data, dict) else None
+        _write(_err(request_id, -32603, f"Internal error: {str(e)}"))
+
+def _stdin_is_pipe():
+    """Whether stdin can be attached to the event loop as a pipe transport"""
+    if sys.platform == "win32":
+        return False
+    fd = sys.stdin.fileno()
+    mode = os.fstat(fd).st_mode
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or os.isatty(fd)
+
+async def _open_stdin():
+    """Return a coroutine function that reads the next chunk of stdin"""
+    loop = asyncio.get_running_loop()
+    
+    if not _stdin_is_pipe():
+        # Regular files, other devices (e.g. /dev/null) and Windows consoles
+        # can't use a pipe transport
+        def read_stdin():
+            return loop.run_in_executor(None, sys.stdin.buffer.readline)
+        return read_stdin
+    
+    # Read stdin directly on the event loop instead of hopping to a thread per line
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: protocol, sys.stdin)
+    
+    def read_stdin():
+        return reader.read(STDIN_READ_SIZE)
+    return read_stdin
 
 async def _async_main():
     """Async main entry point"""
     server = ACPServer()
     
+    # Stateful requests run one at a time in arrival order; only side-effect-free
+    # ones are handled concurrently. Keep references so tasks aren't collected.
+    queue = asyncio.Queue()
+    tasks = set()
+    
+    async def worker():
+        while (request_data := await queue.get()) is not None:
+            await _respond(server, request_data)
+    
+    def dispatch(frame):
+        frame = frame.strip()
+        if not frame:
+            return
+        try:
+            request_data = orjson.loads(frame)
+        except orjson.JSONDecodeError:
+            _write(_err(None, -32700, "Parse error"))
+            return
+        
+        if isinstance(request_data, dict) and request_data.get("method") in CONCURRENT_METHODS:
+            task = asyncio.create_task(_respond(server, request_data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        else:
+            queue.put_nowait(request_data)
+    
+    worker_task = asyncio.create_task(worker())
+    buf = bytearray()
     try:
+        read_stdin = await _open_stdin()
         while True:
-            line = await asyncio.get_event_loop().run_in_executor(None, sys.stdin.readline)
-            if not line:
+            chunk = await read_stdin()
+            if not chunk:
                 break
             
-            line = line.strip()
-            if not line:
-                continue
-            
-            try:
-                request_data = json.loads(line)
-                response = await server.handle_request(request_data)
-                if response:
-                    print(json.dumps(response), flush=True)
-            except json.JSONDecodeError:
-                error_response = {
-                    "jsonrpc": "2.0",
-                    "id": None,
-                    "error": {
-                        "code": -32700,
-                        "message": "Parse error"
-                    }
-                }
-                print(json.dumps(error_response), flush=True)
-            except Exception as e:
-                error_response = {
-                    "jsonrpc": "2.0",
-                    "id": request_data.get("id") if 'request_data' in locals() else None,
-                    "error": {
-                        "code": -32603,
-                        "message": f"Internal error: {str(e)}"
-                    }
-                }
-                print(json.dumps(error_response), flush=True)
+            # Dispatch every complete line received in this read
+            buf += chunk
+            start = 0
+            while (nl := buf.find(b"\n", start)) != -1:
+                dispatch(bytes(buf[start:nl]))
+                start = nl + 1
+            del buf[:start]
+        
+        if buf:
+            dispatch(bytes(buf))
+        queue.put_nowait(None)
+        await worker_task
+        if tasks:
+            await asyncio.gather(*tasks)
                 
     except KeyboardInterrupt:
         pass
+    finally:
+        worker_task.cancel()
+        await server.aclose()
 
 def main():
     """Synchronous entry point for package scripts"""
-    asyncio.run(_async_main())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(_async_main())
+    else:
+        uvloop.run(_async_main())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file